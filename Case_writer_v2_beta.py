@@ -1,12 +1,17 @@
 # Disclaimer: Code written by Gemini 2.5 Pro
 
 import streamlit as st
-import google.generativeai as genai
 from googleapiclient.discovery import build
-import time
+import httplib2
 import os
-from dotenv import load_dotenv
 import json
+from string import Template
+import hashlib
+import datetime
+import diskcache
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -16,8 +21,10 @@ st.set_page_config(
 )
 
 # --- API Configuration ---
+@st.cache_resource(show_spinner=False)
 def load_credentials():
-    """Loads all necessary API keys and IDs securely."""
+    """Loads all necessary API keys and IDs securely, once per app process."""
+    from dotenv import load_dotenv
     load_dotenv()
     gemini_api_key = os.getenv("GEMINI_API_KEY")
     search_api_key = os.getenv("GOOGLE_SEARCH_API_KEY")
@@ -32,18 +39,160 @@ def load_credentials():
             pass
 
     if not all([gemini_api_key, search_api_key, search_engine_id]):
-        st.error("One or more API keys/IDs are missing. Please check your .env file or Streamlit secrets.", icon="🚨")
+        st.error("One or more API keys/IDs are missing. Please check your .env file or Streamlit secrets. Keys are read once per app process, so restart the app after changing them.", icon="🚨")
         st.stop()
         
     return gemini_api_key, search_api_key, search_engine_id
 
 GEMINI_API_KEY, SEARCH_API_KEY, SEARCH_ENGINE_ID = load_credentials()
 
-# Configure Gemini
-genai.configure(api_key=GEMINI_API_KEY)
 # This variable holds the model name for use in the disclaimer
 MODEL_NAME = 'gemini-2.5-flash'
-model = genai.GenerativeModel(MODEL_NAME)
+# The think step and the section summaries are short, simple outputs, so they run on the faster, cheaper model
+THINK_MODEL_NAME = 'gemini-2.5-flash-lite'
+
+@st.cache_resource(show_spinner=False)
+def get_genai():
+    """Imports and configures the Gemini SDK once per app process instead of on every rerun."""
+    # Imported here so the gRPC/protobuf stack loads on first use, not before the first page render
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def get_model(system_instruction=None, model_name=MODEL_NAME):
+    """Builds the model handle once per app process, model and system instruction instead of on every rerun."""
+    return get_genai().GenerativeModel(model_name, system_instruction=system_instruction)
+
+# Upper bound on Gemini requests in flight at once; the free tier throttles aggressively
+GEMINI_CONCURRENCY = 4
+# Identical one-shot prompts are answered from cache for this long (seconds)
+RESPONSE_CACHE_TTL = 24 * 3600
+RESPONSE_CACHE_DIR = ".gemini_cache"
+# Complete runs are kept on disk for this long so a reload or repeat submission costs nothing
+RUN_CACHE_TTL = 7 * 24 * 3600
+# Refuse to start a run whose instructor-supplied prompts alone exceed this many tokens
+MAX_PROMPT_TOKENS = 8000
+# Embeddings rank the Step 0 sources by relevance to the topic
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+# Search results for an identical query are reused for this long (seconds)
+SEARCH_CACHE_TTL = 3600
+# The Step 0 sources in the report prompt are trimmed to about this many tokens, most relevant first;
+# sizes are estimated locally at this many characters per token
+SOURCE_TOKEN_BUDGET = 1000
+CHARS_PER_TOKEN = 4
+# The section writes' system instruction is stored server-side for about the length of one run (seconds)
+# and reused by every section write of that run
+CONTEXT_CACHE_TTL = 600
+
+# The handle is dropped well before the server-side cache expires, so no call ever hits an expired cache
+@st.cache_resource(max_entries=32, ttl=CONTEXT_CACHE_TTL // 2, show_spinner=False)
+def get_cached_model(system_instruction):
+    """Returns a model bound to a server-side cache of the system instruction, billed at the cached-token rate on reuse."""
+    genai = get_genai()
+    from google.generativeai import caching
+    from google.api_core.exceptions import InvalidArgument
+    try:
+        cached_content = caching.CachedContent.create(
+            model=f"models/{MODEL_NAME}", system_instruction=system_instruction,
+            ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL),
+        )
+    except InvalidArgument:
+        # Instructions below the model's minimum cacheable size are rejected; send them inline instead.
+        # Anything else, such as a rate limit, raises so the caller's retry sees it and nothing is cached.
+        return get_model(system_instruction)
+    return genai.GenerativeModel.from_cached_content(cached_content)
+
+# --- Prompt Templates ---
+# Built once when the script runs; each submission only fills in its values.
+REPORT_PROMPT = Template("""In the role of an expert corporate analyst with over 10 years of experience in creating meaningful and effective reports for leadership boards of Fortune 500 companies, please create an industry report for the leadership board of $company_name. The topic of the report is: $case_topic.
+Use the following live web search results as the additional sources for your report:
+---
+$initial_sources
+---
+The leadership board wants to learn the following: $learning_objectives. The leadership board wants to be able to answer the following questions: $student_questions.""")
+
+# The persona names no student-specific details, so it stays byte-identical across submissions
+# for the same instructor setup and forms a stable, cacheable prefix for every later call.
+PERSONA_PROMPT = Template("""Your role: You are a deep expert in $discipline with over 10 years of experience in the named role at the named company.
+
+Your personality: You are extroverted, joyful and kind. You are a deeply analytical thinking, above average creative and you always think outside of the box to find unconventional, yet effective solutions to problems..
+
+Your expertise: You have over 10 years of experience in the named role at the named company. You have taught case studies at ivy league business schools for over 5 years. You also have over 5 years of experience in writing highly engaging and meaningful case studies for $target_audience in top tier business schools.
+
+Your writing style: When writing case studies for $target_audience at top tier business schools, you adhere to the best practices of such quality case studies, but you add your own talent as an experienced storyteller to it. Your defining quality as a case study writer, which makes you stand out from others, is that you are able to write in such a way that the cases become particularly realistic and captivating for the students. You are also building in many engaging elements, which are not typical for case studies, but which make them much more engaging for students and therefore increase the completion rate significantly. Finally, you write based on high quality sources, which you rigorously cite throughout the document.""")
+ASSIGNMENT_PROMPT = Template("For this assignment, the named role is $job_title and the named company is $company_name.")
+
+CASE_STRUCTURE = """- Title Page\n- Introduction\n- Case Study Narrative\n- Analysis of Strategic Decisions\n- Critical Discussion\n- Reflection and Application\n- Supplementary Materials\n- Conclusion"""
+OUTLINE_PROMPT = Template(f"""In this role, you are writing a case study focused on the job of $job_title at $company_name. In this role, please create a brief overview of the case study on $case_topic which achieves the following learning objectives: $learning_objectives. The overview must follow this structure:\n{CASE_STRUCTURE}""")
+
+SECTIONS = (
+    {"step": 4, "title": "Introduction", "description": "Background Information: Provide a brief introduction to the company or brand featured in the case study.\nIndustry Context: Describe the industry landscape and the market conditions at the time of the case study.\nPurpose of the Case Study: Clarify the educational objectives and what students should aim to learn from this case study."},
+    {"step": 5, "title": "Case Study Narrative", "description": "Company Overview: Detail the company’s history, mission, and market position prior to the implementation of the strategy being studied.\nStrategic Assessment: Outline specific challenges or opportunities for the company."},
+    {"step": 6, "title": "Analysis of Strategic Decisions", "description": "Strategic Decision-Making Process: Delve into how decisions were made, including the data and market research used.\nImplementation Challenges: Describe any obstacles encountered during the implementation of the strategy and how they were overcome.\nOutcomes and Performance: Short-Term Results (analyze immediate effects) and Long-Term Impact (assess long-term effects)."},
+    {"step": 7, "title": "Critical Discussion", "description": "Discussion Points: Provide key points for students to consider, fostering critical thinking about strategic choices made by the company.\nAlternative Strategies: Propose alternative strategies that could have been considered, encouraging students to think about different approaches.\nLessons Learned: Highlight key takeaways and lessons learned from the case study."},
+    {"step": 8, "title": "Reflection and Application", "description": "Reflective Questions: Pose thought-provoking questions to help students apply the insights from the case study to their own or other business contexts.\nHow could these strategies be applied in different industries?\nWhat would you have done differently if you were in charge?"},
+    {"step": 9, "title": "Supplementary Materials", "description": "Data Sources: Include data sources, as found online.\nFurther Readings: Suggest additional resources for students who wish to explore related topics in more depth."},
+    {"step": 10, "title": "Conclusion", "description": "Recap: Summarize the main insights and the educational value of the case study.\nNext Steps: Encourage further exploration of the concepts learned and how they tie into the upcoming course material."},
+)
+
+THINK_PROMPT = Template("""I am about to write the '$title' section of a case study.
+My instructions for this section are: $description.
+The sections preceding it in the case study are: $preceding_titles.
+
+Do I need more specific, real-time information to write this section comprehensively? 
+If yes, formulate up to 2 specific Google search queries that would give me the data, examples, or details I need.
+Respond ONLY with a JSON object with two keys: "search_needed" (true/false) and "queries" (a list of strings).
+If no search is needed, the "queries" list should be empty.""")
+# The think step runs in JSON mode against this schema, so its reply parses without any cleanup
+THINK_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "search_needed": {"type": "boolean"},
+        "queries": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["search_needed", "queries"],
+}
+# The think prompts only depend on the static section plan, so they are rendered completely up front
+THINK_PROMPTS = tuple(
+    THINK_PROMPT.substitute(
+        title=section['title'],
+        description=section['description'],
+        preceding_titles=", ".join(previous['title'] for previous in SECTIONS[:index]) or "None",
+    )
+    for index, section in enumerate(SECTIONS)
+)
+
+WRITE_PROMPT = Template("""In your defined role, please write out all details of the section '$title'.
+The specific requirements for this section are: $description
+I have performed a targeted search for you. Use these new sources to inform your writing:
+---
+$new_sources
+---
+Please make sure to take into consideration the content of the preceding parts of the case study that you have already written. In summary, they cover:
+$preceding_parts
+IMPORTANT: Write ONLY the content for the section itself. Do not add meta-commentary.""")
+# Per-section write prompts with the static parts already filled in; only the sources and
+# the summary of the preceding sections are substituted per submission
+SECTION_DELTAS = tuple(
+    Template(WRITE_PROMPT.safe_substitute(title=section['title'], description=section['description']))
+    for section in SECTIONS
+)
+
+# Later sections see this summary instead of the full text, so the context stays flat as the case grows
+SUMMARY_PROMPT = Template("""Summarize the following '$title' section of a case study in at most $max_words words. Keep the key facts, figures, names and arguments that later sections may build on.
+---
+$content
+---""")
+SUMMARY_MAX_WORDS = 200
+
+# Order of the intermediate results in the generation details
+DISPLAY_ORDER = (
+    "0_initial_search", "1_report", "2_persona_prompt", "3_outline", "4_Introduction",
+    "5_Case Study Narrative", "6_Analysis of Strategic Decisions",
+    "7_Critical Discussion", "8_Reflection and Application",
+    "9_Supplementary Materials", "10_Conclusion"
+)
 
 # --- Session State Initialization ---
 if 'instructor_data' not in st.session_state:
@@ -52,40 +201,230 @@ if 'generation_results' not in st.session_state:
     st.session_state.generation_results = {}
 if 'final_case_study' not in st.session_state:
     st.session_state.final_case_study = ""
+if 'system_preamble' not in st.session_state:
+    st.session_state.system_preamble = None
 
 # --- Helper Functions ---
-def perform_google_search(queries, num_per_query=3):
-    """Performs multiple Google searches and returns a formatted string of results."""
-    all_results_text = ""
+@st.cache_resource(show_spinner=False)
+def get_search_service():
+    """Builds the Custom Search client once per app process from the discovery document bundled with the library."""
+    return build("customsearch", "v1", developerKey=SEARCH_API_KEY, cache_discovery=False, static_discovery=True)
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=512, show_spinner=False)
+def _search_one(query, num_per_query):
+    """Runs a single Custom Search request and returns its results as title/url/snippet dicts, cached per query."""
+    request = get_search_service().cse().list(q=query, cx=SEARCH_ENGINE_ID, num=num_per_query)
+    # Each request gets its own HTTP connection, since httplib2 connections are not thread-safe
+    items = request.execute(http=httplib2.Http()).get('items', [])
+    # Only the fields the prompts use are kept, so the cache does not hold the full API payload
+    return [{"title": item.get('title', ''), "url": item['link'], "snippet": item.get('snippet', '')} for item in items if item.get('link')]
+
+def search_items(queries, num_per_query=3):
+    """Runs the Google searches and returns the unique results in query order. Raises on failure and never touches the page, so it is safe on worker threads."""
+    # Google ignores case and extra whitespace, so queries differing only in those share one request
+    # and one cache entry; repeats across sections and reruns are answered by the search cache
+    queries = list(dict.fromkeys(" ".join(query.split()).lower() for query in queries))
+    if not queries:
+        return []
+    # The queries are independent HTTP round-trips, so they are all in flight at once; a single
+    # query runs on the calling thread, which is already a worker during section research
+    if len(queries) == 1:
+        results_per_query = [_search_one(queries[0], num_per_query)]
+    else:
+        with ThreadPoolExecutor(max_workers=len(queries), thread_name_prefix="search") as executor:
+            results_per_query = list(executor.map(lambda query: _search_one(query, num_per_query), queries))
+    unique_items = []
     seen_links = set()
+    for items in results_per_query:
+        for item in items:
+            if item['url'] not in seen_links:
+                unique_items.append(item)
+                seen_links.add(item['url'])
+    return unique_items
+
+def format_search_item(item):
+    """Formats one search result the way the prompts list their sources."""
+    return f"- Title: {item['title']}\n  URL: {item['url']}\n  Snippet: {item['snippet']}\n"
+
+def format_search_items(items):
+    """Formats search results as one string for a prompt."""
+    return "".join(format_search_item(item) for item in items) or "No new search results found."
+
+def perform_google_search(queries, num_per_query=3):
+    """Performs multiple Google searches and returns the unique result items, or None if the search failed."""
+    for query in queries:
+        st.info(f"🤖 Searching for: \"{query}\"")
     try:
-        service = build("customsearch", "v1", developerKey=SEARCH_API_KEY)
-        for query in queries:
-            st.info(f"🤖 Searching for: \"{query}\"")
-            res = service.cse().list(q=query, cx=SEARCH_ENGINE_ID, num=num_per_query).execute()
-            for item in res.get('items', []):
-                link = item.get('link')
-                if link and link not in seen_links:
-                    all_results_text += f"- Title: {item.get('title', '')}\n  URL: {link}\n  Snippet: {item.get('snippet', '')}\n"
-                    seen_links.add(link)
-        return all_results_text if all_results_text else "No new search results found."
+        return search_items(queries, num_per_query)
     except Exception as e:
         st.error(f"An error occurred during Google Search: {e}")
-        return "Search failed."
+        return None
+
+def rank_by_relevance(items, topic):
+    """Orders search results by the embedding similarity of their title and snippet to the topic."""
+    genai = get_genai()
+    texts = [f"{item['title']}\n{item['snippet']}" for item in items]
+    documents = np.asarray(genai.embed_content(model=EMBEDDING_MODEL, content=texts, task_type="retrieval_document")["embedding"])
+    query = np.asarray(genai.embed_content(model=EMBEDDING_MODEL, content=topic, task_type="retrieval_query")["embedding"])
+    similarities = documents @ query / (np.linalg.norm(documents, axis=1) * np.linalg.norm(query))
+    return [items[index] for index in np.argsort(-similarities)]
+
+def trim_to_token_budget(items, topic, budget=SOURCE_TOKEN_BUDGET):
+    """Keeps the results most relevant to the topic that fit the token budget, in order of relevance."""
+    try:
+        ranked = rank_by_relevance(items, topic) if len(items) > 1 else items
+    except Exception:
+        # Ranking is an optimisation; without it the budget is filled in search order
+        ranked = items
+    kept, used_tokens = [], 0
+    for item in ranked:
+        item_tokens = len(format_search_item(item)) // CHARS_PER_TOKEN
+        # The most relevant result is always kept, even if it alone exceeds the budget
+        if kept and used_tokens + item_tokens > budget:
+            continue
+        kept.append(item)
+        used_tokens += item_tokens
+    return kept
+
+def _is_rate_limited(exception):
+    """Returns True if the exception is a Gemini 429 (quota/rate limit) error."""
+    return getattr(exception, "code", None) == 429
+
+_retry_on_rate_limit = retry(
+    retry=retry_if_exception(_is_rate_limited),
+    wait=wait_exponential(multiplier=2, min=2, max=60),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+@_retry_on_rate_limit
+def _send_to_gemini(prompt, system_instruction=None, generation_config=None, model_name=MODEL_NAME):
+    """Sends a prompt to Gemini with the system instruction inline, backing off exponentially while rate limited. Raises on failure."""
+    return get_model(system_instruction, model_name).generate_content(prompt, generation_config=generation_config).text
+
+@_retry_on_rate_limit
+def _stream_gemini(prompt, system_instruction, placeholder):
+    """Streams a response into the placeholder as it arrives and returns the full text."""
+    response = get_cached_model(system_instruction).generate_content(prompt, stream=True)
+    # write_stream renders each chunk as it arrives and hands back the concatenated text
+    return placeholder.write_stream(chunk.text for chunk in response)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Opens the on-disk response cache that survives app restarts."""
+    return diskcache.Cache(RESPONSE_CACHE_DIR)
+
+def _call_gemini_oneshot(prompt, system_instruction=None, reuse=True, model_name=MODEL_NAME):
+    """Returns the response to a single prompt, cached on disk per model, instruction and prompt; reuse=False regenerates it."""
+    disk_cache = get_response_cache()
+    prompt_key = "oneshot_" + hashlib.sha256(json.dumps([model_name, system_instruction, prompt]).encode()).hexdigest()
+    text = disk_cache.get(prompt_key) if reuse else None
+    if text is None:
+        text = _send_to_gemini(prompt, system_instruction, model_name=model_name)
+        disk_cache.set(prompt_key, text, expire=RESPONSE_CACHE_TTL)
+    return text
+
+def call_gemini(prompt, system_instruction, reuse=True):
+    """Streams a response to the page under the given system instruction, cached on disk per instruction and prompt."""
+    cache_key = "section_" + hashlib.sha256(json.dumps([system_instruction, prompt]).encode()).hexdigest()
+    if reuse:
+        try:
+            cached_text = get_response_cache().get(cache_key)
+        except Exception:
+            # The cache is an optimisation; fall through to a normal call if it is unavailable
+            cached_text = None
+        if cached_text is not None:
+            return cached_text
+
+    placeholder = st.empty()
+    try:
+        text = _stream_gemini(prompt, system_instruction, placeholder)
+    except Exception as e:
+        st.error(f"An error occurred with the Gemini API call: {e}")
+        return None
+    finally:
+        # The finished text is shown in the results section, so drop the live preview
+        placeholder.empty()
+    if text:
+        try:
+            get_response_cache().set(cache_key, text, expire=RUN_CACHE_TTL)
+        except Exception:
+            # A failed write only costs a later cache hit, never the section that was just paid for
+            pass
+    return text
+
+@st.cache_resource
+def get_executor():
+    """Returns the worker pool shared by all sessions for concurrent Gemini calls."""
+    return ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY, thread_name_prefix="gemini")
+
+def count_prompt_tokens(contents):
+    """Counts tokens with the free countTokens endpoint; returns None if the count itself fails."""
+    try:
+        return get_model().count_tokens(contents).total_tokens
+    except Exception:
+        return None
 
-def call_gemini(prompt, chat_history=None):
-    """A standard call to the Gemini API for text generation."""
+# --- Pipeline Steps ---
+# Each step is a pure function of its inputs, so repeated inputs are answered from the caches
+def generate_report(company_name, case_topic, learning_objectives, student_questions, initial_sources, reuse=True):
+    """Writes the Step 1 research report; identical inputs give an identical prompt and hit the one-shot cache."""
+    prompt = REPORT_PROMPT.substitute(
+        company_name=company_name, case_topic=case_topic, learning_objectives=learning_objectives,
+        student_questions=student_questions, initial_sources=initial_sources,
+    )
+    return _call_gemini_oneshot(prompt, reuse=reuse)
+
+def build_persona_prompt(discipline, target_audience):
+    """Returns the Step 2 persona prompt. It is plain string assembly, so it is not worth caching."""
+    return PERSONA_PROMPT.substitute(discipline=discipline, target_audience=target_audience)
+
+def build_system_preamble(prompt_values, outline=None):
+    """Returns the system instruction with the writer persona, the student's role and company, and the outline once written."""
+    persona_prompt = build_persona_prompt(prompt_values['discipline'], prompt_values['target_audience'])
+    preamble = f"{persona_prompt}\n\n{ASSIGNMENT_PROMPT.substitute(prompt_values)}"
+    return f"{preamble}\n\nOUTLINE:\n{outline}" if outline else preamble
+
+def get_outline(instructor, job_title, company_name, reuse=True):
+    """Writes the case study outline, cached on disk with the other one-shot responses since it only depends on the setup, role and company."""
+    prompt_values = {**instructor, "company_name": company_name, "job_title": job_title}
+    return _call_gemini_oneshot(OUTLINE_PROMPT.substitute(prompt_values), build_system_preamble(prompt_values), reuse=reuse)
+
+def summarize_section(title, content, reuse=True):
+    """Returns a short summary of a written section for later prompts; falls back to the title if the call fails."""
+    prompt = SUMMARY_PROMPT.substitute(title=title, content=content, max_words=SUMMARY_MAX_WORDS)
     try:
-        if chat_history is not None:
-            chat = model.start_chat(history=chat_history)
-            response = chat.send_message(prompt)
-            return response.text, chat.history
-        else:
-            response = model.generate_content(prompt)
-            return response.text, [{'role': 'user', 'parts': [prompt]}, {'role': 'model', 'parts': [response.text]}]
+        # Summarising sits between section writes on the main thread, so it runs on the fast model
+        return f"- {title}: {_call_gemini_oneshot(prompt, reuse=reuse, model_name=THINK_MODEL_NAME)}"
+    except Exception:
+        return f"- {title}"
+
+def plan_section_research(think_prompt, system_instruction):
+    """Asks Gemini what a section needs and runs those searches, without touching the page. Raises if the think call fails."""
+    generation_config = get_genai().GenerationConfig(response_mime_type="application/json", response_schema=THINK_RESPONSE_SCHEMA)
+    query_response_text = _send_to_gemini(think_prompt, system_instruction, generation_config=generation_config, model_name=THINK_MODEL_NAME)
+    query_decision = json.loads(query_response_text)
+
+    research = {"queries": [], "items": [], "error": None}
+    if query_decision.get("search_needed") and query_decision.get("queries"):
+        research["queries"] = query_decision["queries"]
+        try:
+            research["items"] = search_items(research["queries"])
+        except Exception as e:
+            research["error"] = e
+    return research
+
+def start_section_research(system_instruction):
+    """Starts the research for every section on the worker pool and returns the futures in section order."""
+    return [get_executor().submit(plan_section_research, think_prompt, system_instruction) for think_prompt in THINK_PROMPTS]
+
+def collect_section_research(future):
+    """Waits for one section's research; a failed think call counts as no research."""
+    try:
+        return future.result()
     except Exception as e:
         st.error(f"An error occurred with the Gemini API call: {e}")
-        return None, chat_history
+        return {"queries": [], "items": [], "error": None}
 
 # --- UI and Main Logic ---
 st.title("✍️ Personalized Case Study Writer")
@@ -120,13 +459,42 @@ with student_tab:
         with st.form(key="student_form"):
             company_name = st.text_input("Company Name", "Apple")
             job_title = st.text_input("Job Title", "Head of Global Strategy")
+            use_saved_run = st.checkbox("Reuse saved results when these inputs were generated before (untick to regenerate every step)", value=True)
             submitted_student_form = st.form_submit_button("Generate Full Case Study", type="primary")
 
             if submitted_student_form:
                 st.session_state.generation_results = {}
                 st.session_state.final_case_study = ""
+                # Panes opened for the previous case start closed again for the new one
+                for key in DISPLAY_ORDER:
+                    st.session_state.pop(f"show_{key}", None)
                 instructor = st.session_state.instructor_data
-                chat_history = []
+                # Every value the prompt templates need for this submission, gathered once
+                prompt_values = {**instructor, "company_name": company_name, "job_title": job_title}
+                st.session_state.system_preamble = None
+
+                # --- Reuse a saved run for identical inputs ---
+                run_key = hashlib.sha256(json.dumps({**instructor, "company": company_name, "job": job_title}, sort_keys=True).encode()).hexdigest()
+                saved_run = get_response_cache().get(f"run_{run_key}") if use_saved_run else None
+                if saved_run is not None:
+                    st.session_state.generation_results = saved_run["generation_results"]
+                    st.session_state.final_case_study = saved_run["final_case_study"]
+                    st.rerun()
+
+                # --- Fail fast on oversized instructor inputs ---
+                # The objectives and questions are unbounded text areas that end up in several prompts
+                prompt_tokens = count_prompt_tokens("\n\n".join([
+                    build_persona_prompt(instructor['discipline'], instructor['target_audience']),
+                    REPORT_PROMPT.substitute(prompt_values, initial_sources=""),
+                    OUTLINE_PROMPT.substitute(prompt_values),
+                ]))
+                if prompt_tokens is not None and prompt_tokens > MAX_PROMPT_TOKENS:
+                    st.error(f"The instructor setup is too long ({prompt_tokens} tokens, limit {MAX_PROMPT_TOKENS}). Please shorten the learning objectives or questions.", icon="🚨")
+                    st.stop()
+
+                # The outline only needs the setup, role and company, not the sources or the report,
+                # so it is written in the background while Step 0 searches and collected at Step 3
+                outline_future = get_executor().submit(get_outline, instructor, job_title, company_name, use_saved_run)
 
                 # --- STEP 0 - INTELLIGENT MULTI-SEARCH ---
                 with st.spinner("Step 0/11: Performing intelligent web search for sources..."):
@@ -136,110 +504,134 @@ with student_tab:
                         f"performance analysis of {company_name} in the context of {instructor['case_topic']}",
                         f"strategic challenges and opportunities of {company_name} in the context of {instructor['case_topic']}"
                     ]
-                    initial_sources = perform_google_search(search_queries)
+                    source_items = perform_google_search(search_queries)
+                    if source_items is None:
+                        initial_sources = "Search failed."
+                    else:
+                        initial_sources = format_search_items(trim_to_token_budget(source_items, instructor['case_topic']))
                     st.session_state.generation_results['0_initial_search'] = initial_sources
 
                 # --- STEP 1: RESEARCH REPORT ---
-                with st.spinner("Step 1/11: Synthesizing research report..."):
-                    prompt_step1 = f"""In the role of an expert corporate analyst with over 10 years of experience in creating meaningful and effective reports for leadership boards of Fortune 500 companies, please create an industry report for the leadership board of {company_name}. The topic of the report is: {instructor['case_topic']}.
-                    Use the following live web search results as the additional sources for your report:
-                    ---
-                    {initial_sources}
-                    ---
-                    The leadership board wants to learn the following: {instructor['learning_objectives']}. The leadership board wants to be able to answer the following questions: {instructor['student_questions']}."""
-                    report, _ = call_gemini(prompt_step1)
-                    st.session_state.generation_results['1_report'] = report
+                # No later step reads the report, so it is written in the background alongside the
+                # outline and while the sections are generated, and collected at the end
+                report_future = get_executor().submit(
+                    generate_report, company_name, instructor['case_topic'], instructor['learning_objectives'],
+                    instructor['student_questions'], initial_sources, use_saved_run,
+                )
 
                 # --- STEP 2: PERSONA ---
                 with st.spinner("Step 2/11: Defining writer persona..."):
-                    persona_prompt = f"""Your role: You are a deep expert in {instructor['discipline']} with over 10 years of experience as {job_title} at {company_name}.
-
-Your personality: You are extroverted, joyful and kind. You are a deeply analytical thinking, above average creative and you always think outside of the box to find unconventional, yet effective solutions to problems..
-
-Your expertise: You have over 10 years of experience as {job_title} at {company_name}. You have taught case studies at ivy league business schools for over 5 years. You also have over 5 years of experience in writing highly engaging and meaningful case studies for {instructor['target_audience']} in top tier business schools.
-
-Your writing style: When writing case studies for {instructor['target_audience']} at top tier business schools, you adhere to the best practices of such quality case studies, but you add your own talent as an experienced storyteller to it. Your defining quality as a case study writer, which makes you stand out from others, is that you are able to write in such a way that the cases become particularly realistic and captivating for the students. You are also building in many engaging elements, which are not typical for case studies, but which make them much more engaging for students and therefore increase the completion rate significantly. Finally, you write based on high quality sources, which you rigorously cite throughout the document."""
-                    st.session_state.generation_results['2_persona_prompt'] = persona_prompt
-                    chat_history.append({'role': 'user', 'parts': [persona_prompt]})
-                    chat_history.append({'role': 'model', 'parts': ["Understood. I will now act as this persona for all subsequent tasks."]})
+                    persona_prompt = build_persona_prompt(instructor['discipline'], instructor['target_audience'])
+                    assignment_prompt = ASSIGNMENT_PROMPT.substitute(prompt_values)
+                    st.session_state.generation_results['2_persona_prompt'] = f"{persona_prompt}\n\n{assignment_prompt}"
+                    st.session_state.system_preamble = build_system_preamble(prompt_values)
 
                 # --- STEP 3: OUTLINE ---
                 with st.spinner("Step 3/11: Writing the case study outline..."):
-                    case_structure = """- Title Page\n- Introduction\n- Case Study Narrative\n- Analysis of Strategic Decisions\n- Critical Discussion\n- Reflection and Application\n- Supplementary Materials\n- Conclusion"""
-                    prompt_step3 = f"""In this role, you are writing a case study focused on the job of {job_title} at {company_name}. In this role, please create a brief overview of the case study on {instructor['case_topic']} which achieves the following learning objectives: {instructor['learning_objectives']}. The overview must follow this structure:\n{case_structure}"""
-                    outline, chat_history = call_gemini(prompt_step3, chat_history=chat_history)
+                    try:
+                        outline = outline_future.result()
+                    except Exception as e:
+                        st.error(f"An error occurred with the Gemini API call: {e}")
+                        outline = None
                     st.session_state.generation_results['3_outline'] = outline
+                    # Every later call gets the persona and the outline as its system instruction
+                    # instead of replaying them as chat turns
+                    st.session_state.system_preamble = build_system_preamble(prompt_values, outline)
 
                 # --- STEPS 4-10: AGENTIC WRITING LOOP ---
-                sections_to_write = [
-                    {"step": 4, "title": "Introduction", "description": "Background Information: Provide a brief introduction to the company or brand featured in the case study.\nIndustry Context: Describe the industry landscape and the market conditions at the time of the case study.\nPurpose of the Case Study: Clarify the educational objectives and what students should aim to learn from this case study."},
-                    {"step": 5, "title": "Case Study Narrative", "description": "Company Overview: Detail the company’s history, mission, and market position prior to the implementation of the strategy being studied.\nStrategic Assessment: Outline specific challenges or opportunities for the company."},
-                    {"step": 6, "title": "Analysis of Strategic Decisions", "description": "Strategic Decision-Making Process: Delve into how decisions were made, including the data and market research used.\nImplementation Challenges: Describe any obstacles encountered during the implementation of the strategy and how they were overcome.\nOutcomes and Performance: Short-Term Results (analyze immediate effects) and Long-Term Impact (assess long-term effects)."},
-                    {"step": 7, "title": "Critical Discussion", "description": "Discussion Points: Provide key points for students to consider, fostering critical thinking about strategic choices made by the company.\nAlternative Strategies: Propose alternative strategies that could have been considered, encouraging students to think about different approaches.\nLessons Learned: Highlight key takeaways and lessons learned from the case study."},
-                    {"step": 8, "title": "Reflection and Application", "description": "Reflective Questions: Pose thought-provoking questions to help students apply the insights from the case study to their own or other business contexts.\nHow could these strategies be applied in different industries?\nWhat would you have done differently if you were in charge?"},
-                    {"step": 9, "title": "Supplementary Materials", "description": "Data Sources: Include data sources, as found online.\nFurther Readings: Suggest additional resources for students who wish to explore related topics in more depth."},
-                    {"step": 10, "title": "Conclusion", "description": "Recap: Summarize the main insights and the educational value of the case study.\nNext Steps: Encourage further exploration of the concepts learned and how they tie into the upcoming course material."},
-                ]
-                
-                written_sections = []
-                for section in sections_to_write:
+                # --- AGENT STEPS A+B: THINK & SEARCH (all sections at once) ---
+                # Deciding what to research and running those searches only needs the outline and the
+                # section plan, so every section's research is started now and runs in the background.
+                # Each write only waits for its own section, so later sections are researched while
+                # earlier ones are written. The writes stay sequential because each section builds on
+                # the ones written before it.
+                for section in SECTIONS:
+                    st.info(f"🤖 Thinking: What information do I need for the '{section['title']}' section?")
+                research_futures = start_section_research(st.session_state.system_preamble)
+
+                # Every section is written against the persona and outline only; earlier sections reach
+                # it as short summaries, so the context per call no longer grows with each section.
+                # The summaries are appended to one running string rather than re-joined per section.
+                preceding_parts = ""
+                for section, section_delta, research_future in zip(SECTIONS, SECTION_DELTAS, research_futures):
                     with st.spinner(f"Step {section['step']}/11: Writing the {section['title']}..."):
-                        preceding_parts = "\n\n".join(written_sections) if written_sections else "None"
-                        
-                        # --- AGENT STEP A: THINK & FORMULATE QUERIES ---
-                        st.info(f"🤖 Thinking: What information do I need for the '{section['title']}' section?")
-                        think_prompt = f"""I am about to write the '{section['title']}' section of a case study.
-                        My instructions for this section are: {section['description']}.
-                        The context from previous sections is: {preceding_parts}.
-                        
-                        Do I need more specific, real-time information to write this section comprehensively? 
-                        If yes, formulate up to 2 specific Google search queries that would give me the data, examples, or details I need.
-                        Respond ONLY with a JSON object with two keys: "search_needed" (true/false) and "queries" (a list of strings).
-                        If no search is needed, the "queries" list should be empty."""
-                        
-                        query_response_text, _ = call_gemini(think_prompt, chat_history)
-                        
-                        try:
-                            clean_json_text = query_response_text.strip().replace("```json", "").replace("```", "")
-                            query_decision = json.loads(clean_json_text)
-                        except json.JSONDecodeError:
-                            query_decision = {"search_needed": False, "queries": []}
-
-                        # --- AGENT STEP B: ACT (SEARCH) ---
-                        new_sources = ""
-                        if query_decision.get("search_needed") and query_decision.get("queries"):
-                            new_sources = perform_google_search(query_decision["queries"])
+                        research = collect_section_research(research_future)
+                        for query in research["queries"]:
+                            st.info(f"🤖 Searched for: \"{query}\"")
+                        # The results stay structured until here, where they are formatted for the prompt
+                        if research["error"] is not None:
+                            st.error(f"An error occurred during Google Search: {research['error']}")
+                            new_sources = "Search failed."
+                        elif research["queries"]:
+                            new_sources = format_search_items(research["items"])
+                        else:
+                            new_sources = "No new search was performed for this section."
+                        if research["queries"]:
                             st.session_state.generation_results[f"{section['step']}_{section['title']}_search"] = new_sources
                         
                         # --- AGENT STEP C: SYNTHESIZE & WRITE ---
-                        write_prompt = f"""In your defined role, please write out all details of the section '{section['title']}'.
-                        The specific requirements for this section are: {section['description']}
-                        I have performed a targeted search for you. Use these new sources to inform your writing:
-                        ---
-                        {new_sources if new_sources else "No new search was performed for this section."}
-                        ---
-                        Please make sure to take into consideration the content of the preceding parts of the case study: {preceding_parts}.
-                        IMPORTANT: Write ONLY the content for the section itself. Do not add meta-commentary."""
+                        write_prompt = section_delta.substitute(
+                            new_sources=new_sources,
+                            preceding_parts=preceding_parts or "None",
+                        )
                         
-                        section_content, chat_history = call_gemini(write_prompt, chat_history=chat_history)
+                        section_content = call_gemini(write_prompt, system_instruction=st.session_state.system_preamble, reuse=use_saved_run)
                         st.session_state.generation_results[f"{section['step']}_{section['title']}"] = section_content
-                        written_sections.append(f"## {section['title']}\n{section_content}")
+                        # The last section has no later section to read its summary
+                        if section_content and section is not SECTIONS[-1]:
+                            preceding_parts += summarize_section(section['title'], section_content, use_saved_run) + "\n"
                 
+                with st.spinner("Step 1/11: Finishing the research report..."):
+                    try:
+                        report = report_future.result()
+                    except Exception as e:
+                        st.error(f"An error occurred with the Gemini API call: {e}")
+                        report = None
+                    st.session_state.generation_results['1_report'] = report
+
                 st.success("Full case study generation complete!")
                 st.balloons()
                 
                 # --- STEP 11: Collate the final case study with Title and Disclaimer ---
-                # Create the title and disclaimer
-                title_and_disclaimer = f"# Case Study: {instructor['case_topic']} for {company_name}\n\n"
-                title_and_disclaimer += f"**_Disclaimer: This case study was written by {MODEL_NAME} and may contain hallucinations._**\n\n---\n\n"
-
-                # Join the main body of the case study
-                case_body = "\n\n---\n\n".join(written_sections)
+                # Sections are read back from the results in plan order and joined once; a section
+                # that failed to generate is left out rather than rendered as "None"
+                section_parts = []
+                for section in SECTIONS:
+                    section_content = st.session_state.generation_results.get(f"{section['step']}_{section['title']}")
+                    if section_content:
+                        section_parts.append(f"## {section['title']}\n{section_content}")
+                parts = [
+                    f"# Case Study: {instructor['case_topic']} for {company_name}\n\n",
+                    f"**_Disclaimer: This case study was written by {MODEL_NAME} and may contain hallucinations._**\n\n---\n\n",
+                    "\n\n---\n\n".join(section_parts),
+                ]
+                st.session_state.final_case_study = "".join(parts)
 
-                # Combine everything into the final text
-                st.session_state.final_case_study = title_and_disclaimer + case_body
+                # Only complete runs are saved, so a failed report, outline or section is regenerated next time
+                required_keys = ["1_report", "3_outline"] + [f"{section['step']}_{section['title']}" for section in SECTIONS]
+                if all(st.session_state.generation_results.get(key) for key in required_keys):
+                    get_response_cache().set(
+                        f"run_{run_key}",
+                        {"generation_results": st.session_state.generation_results, "final_case_study": st.session_state.final_case_study},
+                        expire=RUN_CACHE_TTL,
+                    )
 
 # --- Display Generation Results ---
+# As a fragment, flipping a toggle reruns only this list, not the whole page or the final case study
+@st.fragment
+def show_generation_details():
+    """Lists every intermediate result behind a toggle and renders only the opened ones."""
+    for key in DISPLAY_ORDER:
+        if key in st.session_state.generation_results:
+            if "_search" in key:
+                label = f"Agent Search Results for {key.split('_')[1]}"
+            else:
+                title = key.split('_', 1)[1].replace('_', ' ').title()
+                label = f"Step {key.split('_')[0]}: {title}"
+            if st.toggle(label, key=f"show_{key}"):
+                with st.container(border=True):
+                    st.markdown(st.session_state.generation_results[key])
+
 if st.session_state.generation_results:
     st.header("Final Case Study")
     if st.session_state.final_case_study:
@@ -252,18 +644,4 @@ if st.session_state.generation_results:
         )
     
     st.header("Generation Process Details")
-    display_order = [
-        "0_initial_search", "1_report", "2_persona_prompt", "3_outline", "4_Introduction", 
-        "5_Case Study Narrative", "6_Analysis of Strategic Decisions", 
-        "7_Critical Discussion", "8_Reflection and Application", 
-        "9_Supplementary Materials", "10_Conclusion"
-    ]
-    for key in display_order:
-        if key in st.session_state.generation_results:
-            if "_search" in key:
-                 with st.expander(f"Agent Search Results for {key.split('_')[1]}", expanded=False):
-                    st.markdown(st.session_state.generation_results[key])
-            else:
-                title = key.split('_', 1)[1].replace('_', ' ').title()
-                with st.expander(f"Step {key.split('_')[0]}: {title}", expanded=False):
-                    st.markdown(st.session_state.generation_results[key])
\ No newline at end of file
+    show_generation_details()